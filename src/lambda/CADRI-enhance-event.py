@@ -5,11 +5,82 @@ from datetime import datetime, timedelta
 import boto3
 import time
 import traceback
+import cProfile
+import functools
+import random
+import tempfile
+import tracemalloc
 
 logger = logging.getLogger(__name__)
 logger.setLevel(getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO))
 #logging.getLogger().setLevel(logging.DEBUG)
 
+def write_profile(profiler, peak, top_allocations, context):
+    """
+    Write the cProfile stats (.prof, loadable by pstats or snakeviz) and the tracemalloc
+    summary (.memory.json) of an invocation to PROFILING_OUTPUT, an s3:// prefix or a local directory.
+    """
+    request_id = getattr(context, 'aws_request_id', None) or str(int(time.time() * 1000))
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'CADRI-enhance-event')
+    name = f"{function_name}/{time.strftime('%Y/%m/%d', time.gmtime())}/{request_id}"
+    memory = {
+        'peak_bytes': peak,
+        'top_allocations': [
+            {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+            for stat in top_allocations
+        ]
+    }
+    sink = os.environ.get('PROFILING_OUTPUT') or os.path.join(tempfile.gettempdir(), 'cadri-profiles')
+
+    if sink.startswith('s3://'):
+        bucket, _, prefix = sink[len('s3://'):].partition('/')
+        prefix = prefix.strip('/')
+        key = f"{prefix}/{name}" if prefix else name
+        profile_path = os.path.join(tempfile.gettempdir(), f"{request_id}.prof")
+        profiler.dump_stats(profile_path)
+        s3 = boto3.client('s3')
+        try:
+            s3.upload_file(profile_path, bucket, f"{key}.prof")
+            s3.put_object(Bucket=bucket, Key=f"{key}.memory.json", Body=json.dumps(memory))
+        finally:
+            os.remove(profile_path)
+        location = f"s3://{bucket}/{key}"
+    else:
+        location = os.path.join(sink, name)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        profiler.dump_stats(f"{location}.prof")
+        with open(f"{location}.memory.json", 'w') as memory_file:
+            json.dump(memory, memory_file)
+    logger.info(f"Profiled invocation {request_id}: peak traced memory {peak} bytes, profile written to {location}")
+
+def profiled(handler):
+    """
+    Profile a sample of invocations with cProfile and tracemalloc.
+    PROFILING_SAMPLE_RATE (0 to 1, default 0) sets the fraction of invocations profiled.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        sample_rate = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return handler(event, context)
+
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            return handler(event, context)
+        finally:
+            profiler.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            try:
+                write_profile(profiler, peak, top_allocations, context)
+            except Exception as e:
+                logger.warning(f"Unable to write profile: {str(e)}")
+    return wrapper
+
+@profiled
 def lambda_handler(event, context):
     logger.debug(f"Incoming event: {json.dumps(event)}")
     
@@ -23,7 +94,7 @@ def lambda_handler(event, context):
     failed_records = 0
     for record in event['Records']:
         try:
-            response, data = process_message_for_athena(record)
+            response, data, scan_guard = process_message_for_athena(record)
             logger.debug(f"reponse type {type(response)}")
             
             # Ensure response is a dictionary
@@ -35,11 +106,12 @@ def lambda_handler(event, context):
             #response_json=json.loads(json.dumps(response))
             logger.debug(f"response_json type {type(response_json)}")
 
-            table = format_data_as_table(data)
+            table = format_data_as_table(data) if data else ""
             email_table = {
                 "email_table": table
             }
             response_json.update(email_table)
+            response_json["scan_guard"] = scan_guard
             original_alert = json.loads(f'{{ "original_alert": {record["Sns"]["Message"]} }}')
             logger.debug(f"original_alert type {type(original_alert)}")
             response_json.update(original_alert)
@@ -127,10 +199,28 @@ def process_message_for_athena(record):
         # Calculate the duration of the anomaly
         duration = (end_date - start_date).days + 1
 
+        # Specify the Athena database and table name
+        database = os.environ.get('ATHENA_DATABSE')
+        if not database:
+            raise Exception("ATHENA_DATABSE environment variables not set.")
+        table_name = os.environ.get('ATHENA_TABLE')
+        if not table_name:
+            raise Exception("ATHENA_TABLE environment variables not set.")
+        #table_name = 'cur'
+
+        # Estimate the bytes scanned and narrow the window if it is over the budget
+        duration, partition_filter, scan_guard = apply_scan_budget(database, table_name, start_date, end_date, duration)
+        if scan_guard['decision'] in ('over_budget', 'no_partitions'):
+            # Send the alert without the enhanced table rather than run an unbounded scan
+            return [], None, scan_guard
+        if scan_guard['duration_days'] < scan_guard['requested_duration_days']:
+            start_date = end_date - timedelta(days=duration - 1)
+        baseline = scan_guard['baseline_days']
+
         # Calculate date parameters for the query
-        query_start_date = start_date - timedelta(days=duration)
+        query_start_date = start_date - timedelta(days=baseline)
         query_end_date = end_date + timedelta(days=1)
-        previous_period_start_date = start_date - timedelta(days=duration)
+        previous_period_start_date = start_date - timedelta(days=baseline)
         previous_period_end_date = end_date - timedelta(days=duration)
 
         # Format the dates as strings for the SQL query
@@ -141,12 +231,6 @@ def process_message_for_athena(record):
         current_period_start_date_str = start_date.strftime('%Y-%m-%d')
         current_period_end_date_str = end_date.strftime('%Y-%m-%d')
 
-        # Specify the Athena table name
-        table_name = os.environ.get('ATHENA_TABLE')
-        if not table_name:
-            raise Exception("ATHENA_TABLE environment variables not set.")
-        #table_name = 'cur'
-
         athena_query = f"""
             WITH daily_costs AS (
                 SELECT 
@@ -161,6 +245,7 @@ def process_message_for_athena(record):
                     {account_service_and_usage_filter}
                     AND line_item_usage_start_date >= DATE '{query_start_date_str}'
                     AND line_item_usage_start_date < DATE '{query_end_date_str}'
+                    {partition_filter}
                 GROUP BY 
                     line_item_resource_id, 
                     line_item_usage_account_id,
@@ -215,12 +300,166 @@ def process_message_for_athena(record):
         logger.debug(f"Generated Athena query {athena_query}")
         results, data = run_athena_query(athena_query)
         logger.debug(f"Athena results {json.dumps(results)}")    
-        return results, data
+        return results, data, scan_guard
     except Exception as e:
         logger.error(f"Error processing Athena message : {str(e)}")
         logger.error(traceback.format_exc())
         raise
     
+def partition_month(values):
+    """Return the first day of the billing month held by a CUR partition, or None if unknown."""
+    try:
+        if 'billing_period' in values:
+            return datetime.strptime(values['billing_period'], '%Y-%m')
+        if 'year' in values and 'month' in values:
+            return datetime(int(values['year']), int(values['month']), 1)
+    except ValueError:
+        pass
+    return None
+
+def get_table_partitions(database, table_name):
+    """
+    List the partitions of the CUR table from the Glue catalog. Returns the type of each
+    partition key and the partitions as (values, location) pairs. An unpartitioned table
+    is returned as a single partition with no values.
+    """
+    glue = boto3.client('glue')
+    table = glue.get_table(DatabaseName=database, Name=table_name)['Table']
+    key_types = {key['Name']: key.get('Type', 'string') for key in table.get('PartitionKeys', [])}
+    if not key_types:
+        return key_types, [({}, table['StorageDescriptor']['Location'])]
+
+    partitions = []
+    paginator = glue.get_paginator('get_partitions')
+    for page in paginator.paginate(DatabaseName=database, TableName=table_name):
+        for partition in page['Partitions']:
+            values = dict(zip(key_types, partition['Values']))
+            partitions.append((values, partition['StorageDescriptor']['Location']))
+    if not partitions:
+        raise Exception(f"No partitions registered in the Glue catalog for table {table_name}.")
+    return key_types, partitions
+
+def get_location_size(s3_client, location):
+    """Return the total size in bytes of the objects stored under an S3 location."""
+    bucket, _, prefix = location.replace('s3://', '', 1).partition('/')
+    prefix = prefix.rstrip('/')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    size = 0
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/" if prefix else ''):
+        size += sum(obj['Size'] for obj in page.get('Contents', []))
+    return size
+
+def build_partition_filter(partitions, key_types):
+    """
+    Build the SQL predicate restricting the query to the given partitions. Integer keys
+    are compared with numeric literals and string keys with quoted literals.
+    """
+    if key_types and not partitions:
+        # No registered partition holds the window, so match nothing rather than scan the table
+        return 'AND FALSE'
+    conditions = []
+    for values, _ in partitions:
+        if not values:
+            return ''
+        key_conditions = []
+        for key, value in values.items():
+            key_type = key_types[key].lower()
+            if key_type in ('tinyint', 'smallint', 'int', 'integer', 'bigint'):
+                key_conditions.append(f"\"{key}\" = {int(value)}")
+            elif key_type == 'string' or key_type.startswith(('varchar', 'char')):
+                # Escape single quotes in the partition value for the SQL literal
+                escaped_value = value.replace("'", "''")
+                key_conditions.append(f"\"{key}\" = '{escaped_value}'")
+            else:
+                raise Exception(f"Unsupported type {key_type} for partition key {key}.")
+        conditions.append(f"({' AND '.join(key_conditions)})")
+    return f"AND ({' OR '.join(conditions)})"
+
+def apply_scan_budget(database, table_name, start_date, end_date, duration):
+    """
+    Estimate the bytes the CUR query will scan from the Glue partition metadata and,
+    if the estimate is over ATHENA_SCAN_BUDGET_GB, narrow the anomaly and baseline
+    periods (keeping the anomaly end date) to the most billing months that fit. The
+    estimate is the full S3 size of the partitions the query touches, an upper bound
+    on what Athena scans. Returns the anomaly duration to query, the partition filter
+    for the query and the decision taken, which is recorded in the enhanced event.
+    The Athena query must be skipped when the decision is 'over_budget' or 'no_partitions'.
+    """
+    budget_bytes = int(float(os.environ.get('ATHENA_SCAN_BUDGET_GB', '0')) * 1024 ** 3)
+    scan_guard = {
+        'budget_bytes': budget_bytes,
+        'estimated_bytes': None,
+        'requested_duration_days': duration,
+        'duration_days': duration,
+        'baseline_days': duration,
+    }
+    if not budget_bytes:
+        scan_guard['decision'] = 'no_budget'
+        return duration, '', scan_guard
+
+    try:
+        key_types, partitions = get_table_partitions(database, table_name)
+        s3_client = boto3.client('s3')
+
+        # Billing months the requested window touches, from the anomaly end month backwards
+        query_start_month = (start_date - timedelta(days=duration)).replace(day=1, hour=0, minute=0, second=0)
+        month = end_date.replace(day=1, hour=0, minute=0, second=0)
+        months = []
+        while month >= query_start_month:
+            months.append(month)
+            month = (month - timedelta(days=1)).replace(day=1)
+
+        # Partitions with an unknown billing month are scanned whatever the window
+        selected = [(values, location) for values, location in partitions if partition_month(values) is None]
+        estimated_bytes = sum(get_location_size(s3_client, location) for _, location in selected)
+
+        # The estimate only changes at month boundaries, so add whole months while they fit
+        earliest_month = None
+        for month in months:
+            month_partitions = [(values, location) for values, location in partitions if partition_month(values) == month]
+            month_bytes = sum(get_location_size(s3_client, location) for _, location in month_partitions)
+            if estimated_bytes + month_bytes > budget_bytes:
+                if earliest_month is None:
+                    estimated_bytes += month_bytes
+                break
+            estimated_bytes += month_bytes
+            selected += month_partitions
+            earliest_month = month
+
+        scan_guard['estimated_bytes'] = estimated_bytes
+        if earliest_month is None:
+            scan_guard['decision'] = 'over_budget'
+            logger.warning(f"Estimated scan of {estimated_bytes} bytes for the anomaly end month is over the budget of {budget_bytes} bytes, skipping the Athena query")
+            return duration, '', scan_guard
+        if key_types and not selected:
+            scan_guard['decision'] = 'no_partitions'
+            logger.warning("No CUR partitions are registered for the anomaly period, skipping the Athena query")
+            return duration, build_partition_filter(selected, key_types), scan_guard
+
+        if earliest_month == months[-1]:
+            scan_guard['decision'] = 'within_budget'
+        else:
+            # Split the days from the earliest month that fits to the anomaly end between
+            # the anomaly and baseline periods, keeping at least one anomaly day
+            available_days = (end_date - earliest_month).days + 1
+            duration = max(1, available_days // 2)
+            scan_guard['duration_days'] = duration
+            scan_guard['baseline_days'] = min(duration, available_days - duration)
+            scan_guard['decision'] = 'clamped'
+            logger.info(f"Anomaly window clamped from {scan_guard['requested_duration_days']} to {duration} days with a {scan_guard['baseline_days']} day baseline to fit the scan budget of {budget_bytes} bytes")
+        partition_filter = build_partition_filter(selected, key_types)
+    except Exception as e:
+        logger.warning(f"Unable to estimate Athena scan size, running the query unguarded: {str(e)}")
+        scan_guard.update({
+            'estimated_bytes': None,
+            'duration_days': scan_guard['requested_duration_days'],
+            'baseline_days': scan_guard['requested_duration_days'],
+            'decision': 'estimate_unavailable',
+        })
+        return scan_guard['requested_duration_days'], '', scan_guard
+
+    return duration, partition_filter, scan_guard
+
 def run_athena_query(query_id):
     """Return answer to Bedrock Agent in expected format."""
     try:
@@ -1,6 +1,13 @@
 import boto3
+import cProfile
+import functools
+import json
 import logging
 import os
+import random
+import tempfile
+import time
+import tracemalloc
 from botocore.config import Config
 
 logger = logging.getLogger(__name__)
@@ -57,6 +64,25 @@ def create_email_content(event):
         # Create original alert tables
         impact = original_alert.get('impact', {})
         
+        # Note when the analysis window was narrowed to fit the Athena scan budget
+        scan_guard = event['detail'].get('scan_guard', {})
+        scan_guard_html = ""
+        scan_guard_text = ""
+        scan_guard_notice = ""
+        if scan_guard.get('decision') == 'over_budget':
+            scan_guard_notice = (f"The resource analysis was skipped because the estimated Athena scan of "
+                                 f"{round(scan_guard['estimated_bytes'] / 1024 ** 3, 2)} GB is over the budget of "
+                                 f"{round(scan_guard['budget_bytes'] / 1024 ** 3, 2)} GB.")
+        elif scan_guard.get('decision') == 'no_partitions':
+            scan_guard_notice = "The resource analysis was skipped because no Cost and Usage Report data is registered for the anomaly period yet."
+        elif scan_guard.get('decision') == 'clamped':
+            scan_guard_notice = (f"To keep the Athena query within its scan budget, the resources were analyzed over the last "
+                                 f"{scan_guard['duration_days']} day(s) of the anomaly instead of {scan_guard['requested_duration_days']} day(s), "
+                                 f"compared with the {scan_guard['baseline_days']} day(s) before.")
+        if scan_guard_notice:
+            scan_guard_html = f"<p><strong>Note:</strong> {scan_guard_notice}</p>"
+            scan_guard_text = f"\n        Note: {scan_guard_notice}\n"
+        
         # Root causes table
         root_causes = original_alert.get('rootCauses', [])
         root_causes_html = ""
@@ -163,6 +189,7 @@ def create_email_content(event):
             </ul>
             
             <h3>Top Resources Contributing to Cost Anomaly (Enhanced Alert):</h3>
+            {scan_guard_html}
             <table>
                 <thead>
                     <tr>
@@ -211,7 +238,7 @@ def create_email_content(event):
           {f'  - Total Impact: ${impact.get("totalImpact")}' if impact.get('totalImpact') else ''}
           {f'  - Total Impact Percentage: {impact.get("totalImpactPercentage")}%' if impact.get('totalImpactPercentage') else ''}
         
-        Top Resources Contributing to Cost Anomaly (Enhanced Alert):
+        Top Resources Contributing to Cost Anomaly (Enhanced Alert):{scan_guard_text}
         Account ID\tService\tResource ID\tCurrent Cost\tPrevious Cost\tCost Increase\t% Increase{text_rows}{root_causes_text}
         
         Please verify if this cost increase is expected and, if necessary, make any adjustments.
@@ -269,6 +296,72 @@ def modify_email_content(body_html, body_text, unverified_emails, fallback_email
     
     return modified_html, modified_text
 
+def write_profile(profiler, peak, top_allocations, context):
+    """
+    Write the cProfile stats (.prof, loadable by pstats or snakeviz) and the tracemalloc
+    summary (.memory.json) of an invocation to PROFILING_OUTPUT, an s3:// prefix or a local directory.
+    """
+    request_id = getattr(context, 'aws_request_id', None) or str(int(time.time() * 1000))
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'CADRI-send-notification')
+    name = f"{function_name}/{time.strftime('%Y/%m/%d', time.gmtime())}/{request_id}"
+    memory = {
+        'peak_bytes': peak,
+        'top_allocations': [
+            {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+            for stat in top_allocations
+        ]
+    }
+    sink = os.environ.get('PROFILING_OUTPUT') or os.path.join(tempfile.gettempdir(), 'cadri-profiles')
+
+    if sink.startswith('s3://'):
+        bucket, _, prefix = sink[len('s3://'):].partition('/')
+        prefix = prefix.strip('/')
+        key = f"{prefix}/{name}" if prefix else name
+        profile_path = os.path.join(tempfile.gettempdir(), f"{request_id}.prof")
+        profiler.dump_stats(profile_path)
+        s3 = boto3.client('s3')
+        try:
+            s3.upload_file(profile_path, bucket, f"{key}.prof")
+            s3.put_object(Bucket=bucket, Key=f"{key}.memory.json", Body=json.dumps(memory))
+        finally:
+            os.remove(profile_path)
+        location = f"s3://{bucket}/{key}"
+    else:
+        location = os.path.join(sink, name)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        profiler.dump_stats(f"{location}.prof")
+        with open(f"{location}.memory.json", 'w') as memory_file:
+            json.dump(memory, memory_file)
+    logger.info(f"Profiled invocation {request_id}: peak traced memory {peak} bytes, profile written to {location}")
+
+def profiled(handler):
+    """
+    Profile a sample of invocations with cProfile and tracemalloc.
+    PROFILING_SAMPLE_RATE (0 to 1, default 0) sets the fraction of invocations profiled.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        sample_rate = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return handler(event, context)
+
+        profiler = cProfile.Profile()
+        tracemalloc.start()
+        profiler.enable()
+        try:
+            return handler(event, context)
+        finally:
+            profiler.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            try:
+                write_profile(profiler, peak, top_allocations, context)
+            except Exception as e:
+                logger.warning(f"Unable to write profile: {str(e)}")
+    return wrapper
+
+@profiled
 def lambda_handler(event, context):
     """
     Main Lambda handler for sending CADRI cost anomaly alerts via SES